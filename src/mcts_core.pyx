@@ -0,0 +1,58 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+# Compiled versions of the per-step child scans of mcts_vanilla and mcts_modified.
+# Build in place with: cythonize -i mcts_core.pyx
+from libc.math cimport sqrt, INFINITY
+from random import random
+
+
+cpdef Py_ssize_t best_ucb_child(list child_wins, list child_visits, list child_virtual_loss, int sign,
+                                double log_parent, double explore):
+    """ Finds the child with the highest UCB value, see mcts_vanilla.ucb.
+
+    Args:
+        child_wins:         The win counts of the children.
+        child_visits:       The visit counts of the children.
+        child_virtual_loss: The number of simulations in flight through each child.
+        sign:               1 if the bot is player 1, -1 if it is player 2.
+        log_parent:         The natural log of the parent's visit count.
+        explore:            The exploration constant.
+
+    Returns:    The index of the selected child
+
+    """
+    cdef Py_ssize_t i, best_index = 0
+    cdef long wins, visits, virtual_loss
+    cdef double value, inv_visits, best_value = -INFINITY
+
+    for i in range(len(child_visits)):
+        wins = child_wins[i]
+        virtual_loss = child_virtual_loss[i]
+        visits = <long>child_visits[i] + virtual_loss
+        if visits == 0:
+            value = INFINITY
+        else:
+            inv_visits = 1.0 / visits
+            value = (sign * wins - virtual_loss) * inv_visits + explore * sqrt(log_parent * inv_visits)
+        if value > best_value:
+            best_index, best_value = i, value
+    return best_index
+
+
+cpdef Py_ssize_t pick_weighted(list visits_list, long total):
+    """ Selects a child with probability proportional to its visits, see mcts_modified._pick_weighted.
+
+    Args:
+        visits_list: The visit counts of the children.
+        total:       The sum of visits_list.
+
+    Returns:    The index of the selected child
+
+    """
+    cdef double threshold = random() * total
+    cdef long cumulative = 0
+    cdef Py_ssize_t i
+    for i in range(len(visits_list)):
+        cumulative += <long>visits_list[i]
+        if cumulative >= threshold:
+            return i
+    return len(visits_list) - 1
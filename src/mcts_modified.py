@@ -1,11 +1,59 @@
 from mcts_node import MCTSNode
 from p2_t3 import Board
-from random import choice, random
-from math import sqrt, log
+from atexit import register as at_exit
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count, get_all_start_methods, get_context
+from random import randrange, random, getrandbits, seed as random_seed
+from math import sqrt, log, ceil
+from threading import Lock
+
+try:
+    from rollout_njit import pack_state, rollout_njit, seed as njit_seed
+except ImportError:  # numba is optional, fall back to the pure Python rollout
+    rollout_njit = None
 
 num_nodes = 1000
+num_workers = cpu_count()
+num_threads = 1
+leaf_rollouts = 1
+psims = 1
+# Progressive widening: a node may have at most ceil(widening_constant * visits ** widening_exponent) children
+widening_constant = 1.0
+widening_exponent = 0.5
 explore_factor = 2.
 
+def center_distance(action):
+    """ Orders untried actions: squares nearer the center of their sub-board are expanded first. """
+    _, _, r, c = action
+    return abs(r - 1) + abs(c - 1)
+
+def ordered_actions(board: Board, state):
+    """ Lists the legal actions in the order set_actions expects: the action to expand first comes last. Ties in
+    center_distance are broken randomly, so root parallel workers expand different children.
+
+    Args:
+        board: The game setup.
+        state: The state of the game.
+
+    Returns:
+        The legal actions, farthest from their sub-board's center first.
+    """
+    return sorted(board.legal_actions(state), key=lambda action: (center_distance(action), random()), reverse=True)
+
+def can_expand(node: MCTSNode):
+    """ Checks whether progressive widening allows the node another child: a node may have at most
+    ceil(widening_constant * visits ** widening_exponent) children, and at least one.
+
+    Args:
+        node: A tree node whose legal actions have been set.
+
+    Returns:
+        True if the node has an untried action and room for another child.
+    """
+    limit = max(1, ceil(widening_constant * node.visits ** widening_exponent))
+    return bool(node.untried_actions) and len(node.children) < limit
+
 def traverse_nodes(node: MCTSNode, board: Board, state, bot_identity: int):
     """ Traverses the tree until the end criterion are met.
     e.g. find the best expandable node (node with untried action) if it exists,
@@ -20,172 +68,297 @@ def traverse_nodes(node: MCTSNode, board: Board, state, bot_identity: int):
     Returns:
         node:  A node from which the next stage of the search can proceed.
         state: The state associated with that node.
+        path:  The nodes from the starting node down to that node.
 
     """
-    while not board.is_ended(state) and node.untried_actions == []:
-        # If the state is not terminal and there are untried actions, continue traversing
-        if node.child_nodes == {} or all(child.visits == 0 for child in node.child_nodes.values()):
-            # If all child nodes are unvisited, expand the current node
-            return node, state
+    path = [node]
+    while not board.is_ended(state):
+        if node.untried_actions is None:
+            # The legal actions of a node are generated the first time the search reaches it
+            node.set_actions(ordered_actions(board, state))
+        if can_expand(node):
+            break
+
+        # If the state is not terminal and no child may be added, continue traversing
+        if node.total_child_visits == 0:
+            # If every child is still being rolled out by another selection, roll out from this node instead
+            return node, state, path
         else:
             # Select the child node using roulette wheel selection
-            total_visits = sum(child.visits for child in node.child_nodes.values())
-            probabilities = {action: child.visits / total_visits for action, child in node.child_nodes.items()}
-            selected_action = roulette_wheel_selection(probabilities)
-            node = node.child_nodes[selected_action]
+            node = node.children[_pick_weighted(node.child_visits, node.total_child_visits)]
+            path.append(node)
             action = node.parent_action
             state = board.next_state(state, action)
 
-    return node, state
+    return node, state, path
 
-def roulette_wheel_selection(probabilities):
-    """ Selects an action based on probabilities using roulette wheel selection.
+def _pick_weighted(visits_list, total):
+    """ Selects a child with probability proportional to its visits using roulette wheel selection. Replaced by the
+    compiled version in mcts_core if it is built.
 
     Args:
-        probabilities: A dictionary mapping actions to their probabilities.
+        visits_list: The visit counts of the children, in child list order.
+        total:       The sum of visits_list.
 
     Returns:
-        The selected action.
+        The index of the selected child.
     """
-    threshold = random()
-    cumulative_prob = 0
-    for action, prob in probabilities.items():
-        cumulative_prob += prob
-        if cumulative_prob >= threshold:
-            return action
-
-def expand_leaf(node: MCTSNode, board: Board, state):
-    """ Adds a new leaf to the tree by creating a new child node for the given node (if it is non-terminal).
+    threshold = random() * total
+    cumulative = 0
+    for i, visits in enumerate(visits_list):
+        cumulative += visits
+        if cumulative >= threshold:
+            return i
+
+try:
+    from mcts_core import pick_weighted as _pick_weighted
+except ImportError:  # mcts_core.pyx has not been compiled, keep the Python version
+    pass
+
+def expand_leaf(node: MCTSNode, board: Board, state, path: list):
+    """ Adds a new leaf to the tree by creating a new child node for the given node (if it is non-terminal and
+    progressive widening allows it).
 
     Args:
         node:   The node for which a child will be added.
         board:  The game setup.
         state:  The state of the game.
+        path:   The nodes from the root down to node. The added child is appended to it.
 
     Returns:
         node:  The added child node.
         state: The state associated with that node.
 
     """
-    if node.untried_actions:
-        # Choose an untried action
-        action = choice(node.untried_actions)
-        node.untried_actions.remove(action)
+    if can_expand(node):
+        # Choose the untried action closest to the center, which set_actions placed last
+        action = node.untried_actions.pop()
         
         # Apply the action to the current state
         new_state = board.next_state(state, action)
         
-        # Create a new child node
-        child_node = MCTSNode(parent=node, parent_action=action, action_list=board.legal_actions(new_state))
+        # Create a new child node, its legal actions are generated once the search reaches it
+        child_node = MCTSNode(parent=node, parent_action=action)
         
         # Update the tree
-        node.child_nodes[action] = child_node
+        node.add_child(child_node)
+        path.append(child_node)
         
         return child_node, new_state
 
     return node, state
 
-def rollout(board: Board, state):
-    """ Given the state of the game, the rollout plays out the remainder using a heuristic strategy.
+def rollout(board: Board, state, bot_identity: int):
+    """ Given the state of the game, the rollout plays out the remainder randomly, using the compiled rollout when
+    numba is available.
 
     Args:
-        board: The game setup.
-        state: The state of the game.
+        board:        The game setup.
+        state:        The state of the game.
+        bot_identity: The bot's identity, either 1 or 2.
     
     Returns:
-        state: The terminal game state.
+        won: Whether the bot won the game.
 
     """
+    if rollout_njit is not None:
+        return rollout_njit(pack_state(state)) == bot_identity
+
     while not board.is_ended(state):
         legal_actions = board.legal_actions(state)
-        # Use a heuristic strategy to select the next action (you can define your own heuristic here)
-        action = heuristic_strategy(board, state, legal_actions)
+        action = legal_actions[randrange(len(legal_actions))]
         state = board.next_state(state, action)
 
-    return state
+    return board.points_values(state)[bot_identity] == 1
 
-def heuristic_strategy(board, state, legal_actions):
-    """Placeholder for the heuristic strategy implementation."""
-    return choice(legal_actions)  # Placeholder strategy: choose a random legal action
+def backpropagate(path: list, wins_delta: int, visits_delta: int):
+    """ Updates the win and visit count of each node along the path from the root to a leaf.
 
-def backpropagate(node: MCTSNode, won: bool):
-    """ Navigates the tree from a leaf node to the root, updating the win and visit count of each node along the path.
+    Args:
+        path:         The nodes from the root down to the leaf.
+        wins_delta:   The number of rollouts from the leaf that the bot won.
+        visits_delta: The number of rollouts from the leaf.
+
+    """
+    parent = None
+    for node in path:
+        if parent is not None:
+            i = node.parent_index
+            parent.total_child_visits += visits_delta
+            parent.child_visits[i] += visits_delta
+            parent.child_wins[i] += wins_delta
+        node.visits += visits_delta
+        node.wins += wins_delta
+        parent = node
+
+def _search(root_node: MCTSNode, board: Board, current_state, bot_identity: int, n_iters: int, lock: Lock,
+            rollout_executor: ThreadPoolExecutor = None):
+    """ Runs n_iters MCTS iterations on a tree that may be shared with other threads. The iterations are done in
+    batches of psims: all selections and expansions of a batch happen before its rollouts. Roulette wheel selection is
+    randomized, so concurrent threads spread over the tree without needing a virtual loss.
 
     Args:
-        node: A leaf node.
-        won:  An indicator of whether the bot won or lost the game.
+        root_node:        The root of the tree.
+        board:            The game setup.
+        current_state:    The state of the game at the root.
+        bot_identity:     The bot's identity, either 1 or 2.
+        n_iters:          The number of iterations to run.
+        lock:             The lock guarding the tree.
+        rollout_executor: The executor running the leaf_rollouts rollouts of each leaf, or None to run them here.
 
     """
-    while node is not None:
-        node.visits += 1
-        if won:
-            node.wins += 1
-        node = node.parent
+    for batch_start in range(0, n_iters, psims):
+        leaves = []
+
+        with lock:
+            for _ in range(min(psims, n_iters - batch_start)):
+                # Traverse nodes until a leaf node is reached
+                node, state, path = traverse_nodes(root_node, board, current_state, bot_identity)
+
+                # Expand the leaf node if it is non-terminal
+                node, state = expand_leaf(node, board, state, path)
+                leaves.append((path, state))
+
+        # Perform the rollouts from the leaf nodes
+        states = [state for _, state in leaves for _ in range(leaf_rollouts)]
+        if rollout_executor is not None:
+            results = list(rollout_executor.map(rollout, [board] * len(states), states, [bot_identity] * len(states)))
+        else:
+            results = [rollout(board, state, bot_identity) for state in states]
 
-def think(board: Board, current_state):
-    """ Performs MCTS by sampling games and calling the appropriate functions to construct the game tree.
+        # Backpropagate the number of games the bot won from each leaf
+        with lock:
+            for j, (path, _) in enumerate(leaves):
+                wins = sum(results[j * leaf_rollouts:(j + 1) * leaf_rollouts])
+                backpropagate(path, wins, leaf_rollouts)
+
+def _worker(board: Board, current_state, bot_identity: int, n_iters: int, seed: int, settings: dict = None):
+    """ Runs n_iters MCTS iterations on a private tree rooted at current_state, shared by num_threads threads.
 
     Args:
         board:         The game setup.
         current_state: The current state of the game.
+        bot_identity:  The bot's identity, either 1 or 2.
+        n_iters:       The number of iterations to run.
+        seed:          The seed for this worker's random number generator.
+        settings:      The search settings of the calling process, see _settings. A forked worker
+                       applies them first, so it follows changes made after the pool was created.
 
     Returns:
-        The action to be taken from the current state.
+        An action -> visit count dictionary of the root's children.
 
     """
-    bot_identity = board.current_player(current_state) # 1 or 2
-    root_node = MCTSNode(parent=None, parent_action=None, action_list=board.legal_actions(current_state))
+    if settings is not None:
+        globals().update(settings)
+    random_seed(seed)
+    if rollout_njit is not None:
+        njit_seed(seed)
+    root_node = MCTSNode(parent=None, parent_action=None, action_list=ordered_actions(board, current_state))
+    lock = Lock()
+    rollout_executor = ThreadPoolExecutor(leaf_rollouts) if leaf_rollouts > 1 else None
+
+    try:
+        if num_threads > 1:
+            with ThreadPoolExecutor(num_threads) as executor:
+                futures = [executor.submit(_search, root_node, board, current_state, bot_identity,
+                                           n_iters // num_threads + (i < n_iters % num_threads), lock,
+                                           rollout_executor)
+                           for i in range(num_threads)]
+                for future in futures:
+                    future.result()
+        else:
+            _search(root_node, board, current_state, bot_identity, n_iters, lock, rollout_executor)
+    finally:
+        if rollout_executor is not None:
+            rollout_executor.shutdown()
+
+    return dict(zip(root_node.child_actions, root_node.child_visits))
 
-    for _ in range(num_nodes):
-        state = current_state
-        node = root_node
+_pool = None
+_pool_size = 0
 
-        # Traverse nodes until a leaf node is reached
-        node, state = traverse_nodes(node, board, state, bot_identity)
+def _get_pool():
+    """ Returns the process pool shared by all calls to think, creating it on first use and again whenever
+    num_workers changes.
 
-        # Expand the leaf node if it is non-terminal
-        node, state = expand_leaf(node, board, state)
+    The workers are forked, so the driver scripts need no __main__ guard. Where fork is unavailable, or num_workers
+    is 1, None is returned and the search runs in this process instead.
 
-        # Perform a rollout from the leaf node
-        result_state = rollout(board, state)
+    Returns:    The pool, or None
 
-        # Determine if the bot won the game
-        won = is_win(board, result_state, bot_identity)
+    """
+    global _pool, _pool_size
+    size = num_workers if num_workers > 1 and "fork" in get_all_start_methods() else 0
+    if _pool is not None and _pool_size != size:
+        _pool.terminate()
+        _pool, _pool_size = None, 0
+    if size == 0:
+        return None
+    if _pool is None:
+        _pool, _pool_size = get_context("fork").Pool(size), size
+        at_exit(_pool.terminate)
+    return _pool
 
-        # Backpropagate the result
-        backpropagate(node, won)
+def _settings():
+    """ Collects the module settings the search reads, to be sent along with each job to the pool's workers. """
+    return dict(num_threads=num_threads, leaf_rollouts=leaf_rollouts, psims=psims, explore_factor=explore_factor,
+                widening_constant=widening_constant, widening_exponent=widening_exponent)
 
-    # Get the best action from the root node
-    best_action = get_best_action(root_node)
-    
-    print(f"Action chosen: {best_action}")
-    return best_action
+def think(board: Board, current_state):
+    """ Performs MCTS by sampling games and calling the appropriate functions to construct the game tree.
 
-def is_win(board: Board, state, identity_of_bot: int):
-    """ Checks if the state is a win state for the specified bot identity.
+    The num_nodes iterations are split across num_workers processes, each growing its own tree from the
+    current state (root parallelization). The visit counts of the root's children are summed afterwards.
+    Without a process pool a single tree is grown in this process.
+    Each expanded leaf is evaluated with leaf_rollouts rollouts run in parallel (leaf parallelization).
+    Each pass of the search selects and expands psims leaves before rolling them out.
+    Within a process, num_threads threads share one tree.
 
     Args:
-        board:           The game setup.
-        state:           The state of the game.
-        identity_of_bot: The identity of the bot for which the win is checked.
+        board:         The game setup.
+        current_state: The current state of the game.
 
     Returns:
-        True if the bot wins the game, False otherwise.
+        The action to be taken from the current state.
+
     """
-    outcome = board.points_values(state)
-    assert outcome is not None, "is_win was called on a non-terminal state"
-    return outcome[identity_of_bot] == 1
+    bot_identity = board.current_player(current_state) # 1 or 2
+
+    base_seed = getrandbits(32)
+    pool = _get_pool()
+    if pool is not None:
+        settings = _settings()
+        jobs = [(board, current_state, bot_identity, num_nodes // num_workers + (i < num_nodes % num_workers),
+                 base_seed + i, settings)
+                for i in range(num_workers)]
+        results = pool.starmap(_worker, jobs)
+    else:
+        # One tree over all num_nodes iterations searches deeper than several smaller ones run one after another
+        results = [_worker(board, current_state, bot_identity, num_nodes, base_seed)]
+
+    totals = defaultdict(int)
+    for visits in results:
+        for action, count in visits.items():
+            totals[action] += count
 
-def get_best_action(root_node: MCTSNode):
+    # Get the best action from the root node
+    best_action = get_best_action(totals)
+    
+    print(f"Action chosen: {best_action}")
+    return best_action
+
+def get_best_action(visits: dict):
     """ Selects the best action from the root node in the MCTS tree.
 
     Args:
-        root_node: The root node.
+        visits: The action -> visit count dictionary of the root's children, summed over all workers.
 
     Returns:
         action: The best action from the root node.
     
     """
-    if not root_node.child_nodes:
-        return None
-    return max(root_node.child_nodes.keys(), key=lambda x: root_node.child_nodes[x].visits)
+    best_action, best_visits = None, -1
+    for action, count in visits.items():
+        if count > best_visits:
+            best_action, best_visits = action, count
+    return best_action
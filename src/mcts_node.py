@@ -1,25 +1,72 @@
 
 
 class MCTSNode:
-    def __init__(self, parent=None, parent_action=None, action_list=[]):
+    # Fixed attribute layout, so nodes carry no per-instance __dict__
+    __slots__ = ('parent', 'parent_action', 'parent_index',
+                 'child_actions', 'children', 'child_wins', 'child_visits', 'child_virtual_loss', 'untried_actions',
+                 'wins', 'visits', 'total_child_visits')
+
+    def __init__(self, parent=None, parent_action=None, action_list=None):
         """ Initializes the tree node for MCTS. The node stores links to other nodes in the tree (parent and child
         nodes), as well as keeps track of the number of wins and total simulations that have visited the node.
 
         Args:
             parent:         The parent node of this node.
             parent_action:  The action taken from the parent node that transitions the state to this node.
-            action_list:    The list of legal actions to be considered at this node.
+            action_list:    The list of legal actions to be considered at this node. If None, they are supplied later
+                            through set_actions, once the search first reaches the node.
 
         """
         self.parent = parent                    # Parent node to this node
         self.parent_action = parent_action      # The move that got us to this node - "None" for the root node.
+        self.parent_index = None                # Position of this node in the parent's child lists.
 
-        self.child_nodes = {}                   # Action -> MCTSNode dictionary of children
-        self.untried_actions = action_list      # Yet unexplored actions
+        # Children are stored as parallel lists, indexed in the order they were expanded.
+        # The counters stay lists of Python ints: for the handful of children most nodes have, array('i') is
+        # larger and every read or write re-boxes the value.
+        self.child_actions = []                 # Action leading to each child
+        self.children = []                      # MCTSNode of each child
+        self.child_wins = []                    # Wins of each child
+        self.child_visits = []                  # Visits of each child
+        self.child_virtual_loss = None          # In-flight simulations currently passing through each child - only
+                                                # mcts_vanilla uses it, creating the list with the first child.
+        self.untried_actions = None             # Yet unexplored actions, the next one to try last - "None" until
+                                                # set_actions is called.
 
         self.wins = 0                           # Total wins of all paths through this node.
         self.visits = 0                         # Number of times this node has been visited.
 
+        self.total_child_visits = 0             # Sum of the visits of all child nodes.
+
+        if action_list is not None:
+            self.set_actions(action_list)
+
+    def set_actions(self, action_list):
+        """ Sets the legal actions to be considered at this node.
+
+        Args:
+            action_list:    The list of legal actions, ordered so that the action to try first is last. The node
+                            takes ownership of the list.
+
+        """
+        self.untried_actions = action_list
+
+    def add_child(self, child):
+        """ Appends a child node to the child lists.
+
+        Args:
+            child:  The new child node, whose parent_action has been set.
+
+        Returns:    The index of the child in the child lists.
+
+        """
+        child.parent_index = len(self.children)
+        self.child_actions.append(child.parent_action)
+        self.children.append(child)
+        self.child_wins.append(0)
+        self.child_visits.append(0)
+        return child.parent_index
+
     def __repr__(self):
         """
         This method provides a string representing the node. Any time str(node) is used, this method is called.
@@ -40,6 +87,6 @@ class MCTSNode:
         """
         string = ''.join(['| ' for i in range(indent)]) + str(self) + '\n'
         if horizon > 0:
-            for child in self.child_nodes.values():
+            for child in self.children:
                 string += child.tree_to_string(horizon - 1, indent + 1)
         return string
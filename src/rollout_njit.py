@@ -0,0 +1,109 @@
+import numpy as np
+from numba import njit
+
+# Same lines as p2_t3.Board.wins, over the 3x3 bitmask of a (sub-)board.
+WINS = np.array([0x007, 0x038, 0x1c0, 0x049, 0x092, 0x124, 0x111, 0x054], dtype=np.int16)
+
+
+def pack_state(state):
+    """ Converts a p2_t3 state tuple into the array used by rollout_njit.
+
+    Args:
+        state: The state of the game.
+
+    Returns:    An int16 array holding the same 23 fields, with the None constraint stored as -1
+
+    """
+    return np.array([-1 if value is None else value for value in state], dtype=np.int16)
+
+
+@njit(cache=True)
+def seed(value):
+    """ Seeds the random number generator used inside compiled code. """
+    np.random.seed(value & 0xffffffff)
+
+
+@njit(cache=True)
+def _has_line(mask):
+    for w in WINS:
+        if mask & w == w:
+            return True
+    return False
+
+
+@njit(cache=True)
+def _winner(state):
+    # -1 while the game is still going, 0 for a draw, otherwise the winning player
+    p1 = state[18] & ~state[19]
+    p2 = state[19] & ~state[18]
+    if _has_line(p1):
+        return 1
+    if _has_line(p2):
+        return 2
+    if state[18] | state[19] == 0x1ff:
+        return 0
+    return -1
+
+
+@njit(cache=True)
+def _legal_actions(state, actions):
+    # Fills actions with 9 * sub-board + cell for every legal move and returns how many there are
+    finished = state[18] | state[19]
+    first, last = 0, 9
+    if state[20] >= 0:
+        first = 3 * state[20] + state[21]
+        last = first + 1
+
+    n = 0
+    for b in range(first, last):
+        if finished & (1 << b):
+            continue
+        occupied = state[2 * b] | state[2 * b + 1]
+        for cell in range(9):
+            if not occupied & (1 << cell):
+                actions[n] = 9 * b + cell
+                n += 1
+    return n
+
+
+@njit(cache=True)
+def _apply(state, action):
+    # In-place equivalent of p2_t3.Board.next_state
+    b, cell = action // 9, action % 9
+    player = state[22]
+    player_index = player - 1
+
+    state[22] = 3 - player
+    state[2 * b + player_index] |= 1 << cell
+
+    if _has_line(state[2 * b + player_index]):
+        state[18 + player_index] |= 1 << b
+    elif state[2 * b] | state[2 * b + 1] == 0x1ff:
+        state[18] |= 1 << b
+        state[19] |= 1 << b
+
+    if (state[18] | state[19]) & (1 << cell):
+        state[20], state[21] = -1, -1
+    else:
+        state[20], state[21] = cell // 3, cell % 3
+
+
+@njit(cache=True, nogil=True)
+def rollout_njit(state):
+    """ Plays out the remainder of the game randomly. The GIL is released while the rollout runs, so rollouts on
+    several threads run in parallel.
+
+    Args:
+        state: The state of the game, as returned by pack_state. It is not modified.
+
+    Returns:    The winning player, or 0 for a draw
+
+    """
+    state = state.copy()
+    actions = np.empty(81, dtype=np.int64)
+    while True:
+        winner = _winner(state)
+        if winner >= 0:
+            return winner
+        n = _legal_actions(state, actions)
+        _apply(state, actions[np.random.randint(n)])
@@ -0,0 +1,5 @@
+#!/bin/sh
+# Runs the simulator under PyPy, e.g. ./run_pypy.sh mcts_vanilla rollout_bot
+# numba and the Cython build of mcts_core are CPython-only, so the bots fall back to their pure Python code,
+# which PyPy's JIT compiles instead. Set PYPY to use an interpreter other than pypy3.
+cd "$(dirname "$0")" && exec "${PYPY:-pypy3}" p2_sim.py "$@"